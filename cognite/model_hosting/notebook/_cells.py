@@ -0,0 +1,53 @@
+import re
+
+MODEL_MARKER = "model"
+REQUIREMENTS_MARKER = "requirements"
+
+_CELL_MARKER_RE = re.compile(r"# *!({}|{}) *\n?".format(MODEL_MARKER, REQUIREMENTS_MARKER))
+
+
+class InvalidRequirements(Exception):
+    """Raised if your cell defining requirements is not correctly formatted."""
+
+    pass
+
+
+def get_cell_marker(cell):
+    """Returns the marker comment (`# !model` or `# !requirements`) on the first line of a code cell, if any."""
+    if cell["cell_type"] != "code" or not cell["source"]:
+        return None
+
+    first_line = cell["source"][0]
+    if not first_line.startswith("#"):
+        return None
+    match = _CELL_MARKER_RE.fullmatch(first_line)
+    return match.group(1) if match else None
+
+
+def is_model_cell(cell, marker):
+    if cell["cell_type"] != "code" or not cell["source"]:
+        return False
+    return marker == MODEL_MARKER or "model" in cell.get("metadata", {}).get("tags", ())
+
+
+def is_raw_requirement_cell(cell):
+    return cell["cell_type"] == "raw" and "requirements" in cell.get("metadata", {}).get("tags", ())
+
+
+def is_requirement_cell(cell, marker):
+    return is_raw_requirement_cell(cell) or marker == REQUIREMENTS_MARKER
+
+
+def split_notebook_cells(notebook):
+    """Returns the model cells and the requirement cell of a notebook, found in a single pass over its cells."""
+    model_cells = []
+    requirement_cell = None
+    for cell in notebook["cells"]:
+        marker = get_cell_marker(cell)
+        if is_model_cell(cell, marker):
+            model_cells.append(cell)
+        if is_requirement_cell(cell, marker):
+            if requirement_cell is not None:
+                raise InvalidRequirements("Only one requirement cell is allowed, but found multiple")
+            requirement_cell = cell
+    return model_cells, requirement_cell
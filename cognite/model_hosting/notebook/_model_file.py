@@ -1,12 +1,10 @@
+import ast
 import enum
-import re
+import functools
+import tokenize
+from collections import namedtuple
 
-
-def _should_include_code_cell(cell):
-    include_by_tag = "metadata" in cell and "tags" in cell["metadata"] and "model" in cell["metadata"]["tags"]
-    include_by_comment = bool(re.fullmatch(r"# *!model *\n?", cell["source"][0]))
-
-    return include_by_tag or include_by_comment
+from cognite.model_hosting.notebook._cells import split_notebook_cells
 
 
 class InvalidCodeFormat(Exception):
@@ -15,59 +13,171 @@ class InvalidCodeFormat(Exception):
     pass
 
 
-def extract_source_code(notebook):
+def get_source_code(model_cells):
     source_code = []
-    for cell in notebook["cells"]:
-        if cell["cell_type"] == "code" and cell["source"]:
-            if _should_include_code_cell(cell):
-                source_code.append("# !notebook-cell\n")
-                source_code.extend(cell["source"] + ["\n\n\n"])
-    return "".join(source_code[:-1] + ["\n"])
-
-
-def _get_function_signature(source_code, function_name):
-    parameter_signatures = []
-    for line in source_code.split("\n"):
-        match = re.fullmatch(r"def {}\(([^)]*)\): *".format(function_name), line)
-        if match:
-            parameter_signatures.append(match.group(1))
-
-    if not parameter_signatures:
+    for cell in model_cells:
+        source_code.append("# !notebook-cell\n")
+        source_code.extend(cell["source"])
+        source_code.append("\n\n\n")
+    source_code[-1:] = ["\n"]
+    return "".join(source_code)
+
+
+def extract_source_code(notebook):
+    model_cells, _ = split_notebook_cells(notebook)
+    return get_source_code(model_cells)
+
+
+_Signature = namedtuple("_Signature", ["parameters", "positional_only", "vararg", "kwonlyargs", "kwarg", "defaults"])
+
+_OPENING_BRACKETS = ("(", "[", "{")
+_CLOSING_BRACKETS = (")", "]", "}")
+
+
+def _get_source_text(lines, start, end):
+    (start_row, start_col), (end_row, end_col) = start, end
+    if start_row == end_row:
+        return lines[start_row - 1][start_col:end_col]
+    text = [lines[start_row - 1][start_col:]] + lines[start_row : end_row - 1] + [lines[end_row - 1][:end_col]]
+    return "".join(text)
+
+
+def _get_parameter_defaults(source_code, node):
+    """Returns the source text of the default values in the signature of a function definition, by parameter name.
+
+    The AST only holds the evaluated structure of a default value, so the text is taken from the tokens of the
+    signature, which also keeps brackets and strings inside default values (like `sep=")"`) intact.
+    """
+    # In Python < 3.8 the line number of a decorated function is the line of its first decorator
+    lines = source_code.splitlines(True)[node.lineno - 1 :]
+    tokens = tokenize.generate_tokens(iter(lines + [""]).__next__)
+
+    previous = (None, None)
+    for token in tokens:
+        if token.string == "(" and previous == ("def", node.name):
+            break
+        if token.type == tokenize.NAME:
+            previous = (previous[1], token.string)
+
+    defaults = {}
+    depth = 0
+    name = None
+    default_tokens = None
+    for token in tokens:
+        if token.type in (tokenize.NL, tokenize.NEWLINE, tokenize.COMMENT):
+            continue
+        if depth == 0 and token.string in (",", ")"):
+            if name is not None and default_tokens:
+                defaults[name] = _get_source_text(lines, default_tokens[0].start, default_tokens[-1].end)
+            if token.string == ")":
+                break
+            name, default_tokens = None, None
+            continue
+
+        if token.string in _OPENING_BRACKETS:
+            depth += 1
+        elif token.string in _CLOSING_BRACKETS:
+            depth -= 1
+
+        if default_tokens is not None:
+            default_tokens.append(token)
+        elif depth == 0 and token.string == "=":
+            default_tokens = []
+        elif name is None and token.type == tokenize.NAME:
+            name = token.string
+    return defaults
+
+
+def _get_signature(source_code, node):
+    args = node.args
+    positional_only = [arg.arg for arg in getattr(args, "posonlyargs", [])]
+    has_defaults = bool(args.defaults) or any(default is not None for default in args.kw_defaults)
+    return _Signature(
+        parameters=positional_only + [arg.arg for arg in args.args],
+        positional_only=positional_only,
+        vararg=args.vararg.arg if args.vararg else None,
+        kwonlyargs=[arg.arg for arg in args.kwonlyargs],
+        kwarg=args.kwarg.arg if args.kwarg else None,
+        defaults=_get_parameter_defaults(source_code, node) if has_defaults else {},
+    )
+
+
+@functools.lru_cache(maxsize=16)
+def _get_function_definitions(source_code):
+    try:
+        tree = ast.parse(source_code)
+    except SyntaxError as e:
+        raise InvalidCodeFormat("The model code is not valid Python: {}".format(e))
+
+    function_definitions = {}
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef):
+            function_definitions.setdefault(node.name, []).append(_get_signature(source_code, node))
+    return function_definitions
+
+
+def _get_function_signature(function_definitions, function_name):
+    definitions = function_definitions.get(function_name)
+    if not definitions:
         return None
-    if len(parameter_signatures) > 1:
+    if len(definitions) > 1:
         raise InvalidCodeFormat("Multiple definitions of {}()".format(function_name))
 
-    return parameter_signatures[0]
+    signature = definitions[0]
+    names = signature.parameters + signature.kwonlyargs + [n for n in (signature.vararg, signature.kwarg) if n]
+    if len(names) != len(set(names)):
+        raise InvalidCodeFormat("Duplicate parameters `` in {}()".format(function_name))
+    return signature
 
 
-def _source_code_has_function(source_code, name, parameter_pattern, parameter_error_msg):
-    parameters = _get_function_signature(source_code, name)
-    if parameters is None:
+def _source_code_has_function(
+    function_definitions, name, required_parameters, parameter_error_msg, allow_additional_parameters=True
+):
+    signature = _get_function_signature(function_definitions, name)
+    if signature is None:
         return False
 
-    if re.fullmatch(parameter_pattern, parameters):
+    parameters = signature.parameters
+    has_required_parameters = parameters[: len(required_parameters)] == required_parameters
+    has_additional_parameters = (
+        len(parameters) > len(required_parameters)
+        or signature.vararg is not None
+        or bool(signature.kwonlyargs)
+        or signature.kwarg is not None
+    )
+    if has_required_parameters and (allow_additional_parameters or not has_additional_parameters):
         return True
     raise InvalidCodeFormat(parameter_error_msg)
 
 
 def _source_code_has_train(source_code):
+    # Cheap check to avoid parsing source code which can't define the function
+    if "train_model" not in source_code:
+        return False
     return _source_code_has_function(
-        source_code,
+        _get_function_definitions(source_code),
         name="train_model",
-        parameter_pattern=r"open_artifact(,.*)?",
+        required_parameters=["open_artifact"],
         parameter_error_msg="train_model() must have `open_artifact` as first parameter (additional user specified parameters are also allowed)",
     )
 
 
 def _source_code_has_load_and_predict(source_code):
+    if "load_model" not in source_code and "predict" not in source_code:
+        return False, False
+    function_definitions = _get_function_definitions(source_code)
     has_load = _source_code_has_function(
-        source_code, "load_model", r"open_artifact", "load_model() must have `open_artifact` as the only parameter"
+        function_definitions,
+        name="load_model",
+        required_parameters=["open_artifact"],
+        parameter_error_msg="load_model() must have `open_artifact` as the only parameter",
+        allow_additional_parameters=False,
     )
     if has_load:
         has_predict = _source_code_has_function(
-            source_code,
+            function_definitions,
             name="predict",
-            parameter_pattern=r"model, instance(,.*)?",
+            required_parameters=["model", "instance"],
             parameter_error_msg=(
                 "predict() must have `model` as first parameter and `instance` as second parameter "
                 "(additional user specified parameters are also allowed) when there's a load_model() function"
@@ -75,9 +185,9 @@ def _source_code_has_load_and_predict(source_code):
         )
     else:
         has_predict = _source_code_has_function(
-            source_code,
+            function_definitions,
             name="predict",
-            parameter_pattern=r"instance(,.*)?",
+            required_parameters=["instance"],
             parameter_error_msg=(
                 "predict() must have `instance` as first parameter"
                 "(additional user specified parameters are also allowed) when there's no load_model() function"
@@ -90,33 +200,55 @@ def _source_code_has_load_and_predict(source_code):
     return has_load, has_predict
 
 
-def _get_function_parameters(source_code, function_name):
-    parameters = _get_function_signature(source_code, function_name)
-    assert parameters is not None, "The function `{}` is not defined".format(function_name)
-    parameters = parameters.split(",")
-    parameters = [p.strip() for p in parameters]
-    if len(parameters) != len(set(parameters)):
-        raise InvalidCodeFormat("Duplicate parameters `` in {}()".format(function_name))
-    return parameters
+def _with_default(signature, name):
+    if name in signature.defaults:
+        return "{}={}".format(name, signature.defaults[name])
+    return name
+
 
+def _get_glue_parameters(signature, skip):
+    """Returns the parameter list and the matching call arguments for the user defined parameters of a function."""
+    parameters = [_with_default(signature, name) for name in signature.parameters[skip:]]
+    arguments = []
+    for name in signature.parameters[skip:]:
+        # Defaulted parameters are forwarded by name, unless they must stay positional to be followed by *args
+        by_name = name in signature.defaults and signature.vararg is None and name not in signature.positional_only
+        arguments.append("{0}={0}".format(name) if by_name else name)
+    if signature.vararg is not None:
+        parameters.append("*" + signature.vararg)
+        arguments.append("*" + signature.vararg)
+    elif signature.kwonlyargs:
+        parameters.append("*")
+    parameters.extend(_with_default(signature, name) for name in signature.kwonlyargs)
+    arguments.extend("{0}={0}".format(name) for name in signature.kwonlyargs)
+    if signature.kwarg is not None:
+        parameters.append("**" + signature.kwarg)
+        arguments.append("**" + signature.kwarg)
+    return ", ".join(parameters), ", ".join(arguments)
 
-def _get_user_defined_predict_parameters(source_code):
-    parameters = _get_function_parameters(source_code, "predict")
-    return parameters[parameters.index("instance") + 1 :]
 
+def _get_user_defined_predict_parameters(function_definitions):
+    signature = _get_function_signature(function_definitions, "predict")
+    return _get_glue_parameters(signature, skip=signature.parameters.index("instance") + 1)
 
-def _get_user_defined_train_parameters(source_code):
-    parameters = _get_function_parameters(source_code, "train_model")
-    return parameters[1:]
+
+def _get_user_defined_train_parameters(function_definitions):
+    return _get_glue_parameters(_get_function_signature(function_definitions, "train_model"), skip=1)
 
 
 _glue_code_start = "# !auto-generated\nclass Model:"
 _glue_code_constructor_with_state = "    def __init__(self, model):\n        self._model = model\n"
-_glue_code_train = "    @staticmethod\n    def train(open_artifact, {}):\n        train_model(open_artifact, {})\n"
+_glue_code_train = (
+    "    @staticmethod\n    def train(open_artifact, {parameters}):\n        train_model(open_artifact, {arguments})\n"
+)
 _glue_code_load = "    @staticmethod\n    def load(open_artifact):\n        return Model(load_model(open_artifact))\n"
 _glue_code_stateless_load = "    @staticmethod\n    def load(open_artifact):\n        return Model()\n"
-_glue_code_predict = "    def predict(self, instance, {}):\n        return predict(self._model, instance, {})\n"
-_glue_code_stateless_predict = "    def predict(self, instance, {}):\n        return predict(instance, {})\n"
+_glue_code_predict = (
+    "    def predict(self, instance, {parameters}):\n        return predict(self._model, instance, {arguments})\n"
+)
+_glue_code_stateless_predict = (
+    "    def predict(self, instance, {parameters}):\n        return predict(instance, {arguments})\n"
+)
 
 
 class AvailableOperations(enum.Enum):
@@ -125,6 +257,7 @@ class AvailableOperations(enum.Enum):
     PREDICT_TRAIN = 3
 
 
+@functools.lru_cache(maxsize=8)
 def get_model_file_content(source_code, available_operations):
     has_train = _source_code_has_train(source_code)
     has_load, has_predict = _source_code_has_load_and_predict(source_code)
@@ -150,22 +283,21 @@ def get_model_file_content(source_code, available_operations):
     if has_load:
         content.append(_glue_code_constructor_with_state)
 
+    if has_train or has_predict:
+        # Only reached when one of the checks above already parsed the source code, so this is a cache hit
+        function_definitions = _get_function_definitions(source_code)
+
     if has_train:
-        user_defined_parameters = _get_user_defined_train_parameters(source_code)
-        user_defined_parameters = ", ".join(user_defined_parameters)
-        content.append(_glue_code_train.format(user_defined_parameters, user_defined_parameters))
+        parameters, arguments = _get_user_defined_train_parameters(function_definitions)
+        content.append(_glue_code_train.format(parameters=parameters, arguments=arguments))
 
     if has_predict:
+        parameters, arguments = _get_user_defined_predict_parameters(function_definitions)
         if has_load:
             content.append(_glue_code_load)
+            content.append(_glue_code_predict.format(parameters=parameters, arguments=arguments))
         else:
             content.append(_glue_code_stateless_load)
-
-        user_defined_parameters = _get_user_defined_predict_parameters(source_code)
-        user_defined_parameters = ", ".join(user_defined_parameters)
-        if has_load:
-            content.append(_glue_code_predict.format(user_defined_parameters, user_defined_parameters))
-        else:
-            content.append(_glue_code_stateless_predict.format(user_defined_parameters, user_defined_parameters))
+            content.append(_glue_code_stateless_predict.format(parameters=parameters, arguments=arguments))
 
     return "\n".join(content)
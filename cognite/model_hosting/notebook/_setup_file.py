@@ -1,14 +1,13 @@
+import functools
 import re
+import string
 
+from cognite.model_hosting.notebook._cells import InvalidRequirements, is_raw_requirement_cell, split_notebook_cells
 
-class InvalidRequirements(Exception):
-    """Raised if your cell defining requirements is not correctly formatted."""
-
-    pass
-
-
-def _is_raw_requirement_cell(cell):
-    return cell["cell_type"] == "raw" and "tags" in cell["metadata"] and "requirements" in cell["metadata"]["tags"]
+# Accepts the version comparison operators <, <=, !=, ==, >=, >, ~= and ===
+_VALID_REQUIREMENT_RE = re.compile(r"[a-z0-9][a-z0-9_.\-]*((===|[=!~<>]=|[<>])[^ \n]+)?")
+_REQUIREMENT_NAME_START = frozenset(string.ascii_lowercase + string.digits)
+_DELETE_REQUIREMENT_NAME_CHARACTERS = str.maketrans("", "", string.ascii_lowercase + string.digits + "_.-")
 
 
 def _extract_raw_requirement_cell(cell):
@@ -18,14 +17,16 @@ def _extract_raw_requirement_cell(cell):
     return requirements
 
 
-def _is_comment_requirement_cell(cell):
-    return cell["cell_type"] == "code" and cell["source"] and re.fullmatch(r"# *!requirements *\n?", cell["source"][0])
+def _is_valid_requirement(requirement):
+    # Plain package names without a version specifier are accepted without running the regex
+    if requirement[:1] in _REQUIREMENT_NAME_START and not requirement.translate(_DELETE_REQUIREMENT_NAME_CHARACTERS):
+        return True
+    return bool(_VALID_REQUIREMENT_RE.fullmatch(requirement))
 
 
 def _sanity_check_requirements(requirements):
-    valid_cmp_operators = ["<", "<=", "!=", "==", ">=", ">", "~=", "==="]
     for requirement in requirements:
-        if not re.fullmatch("[a-z0-9][a-z0-9_\-.]*(({})[^ \n]+)?".format("|".join(valid_cmp_operators)), requirement):
+        if not _is_valid_requirement(requirement):
             raise InvalidRequirements("Invalid format for the requirement `{}`".format(requirement))
 
 
@@ -41,37 +42,30 @@ def _extract_comment_requirement_cell(cell):
     return requirements
 
 
-def _requirement_cells(notebook):
-    requirement_cells = []
-    for cell in notebook["cells"]:
-        if _is_raw_requirement_cell(cell):
-            requirement_cells.append(cell)
-        elif _is_comment_requirement_cell(cell):
-            requirement_cells.append(cell)
-
-    return requirement_cells
-
-
-def extract_requirements(notebook):
-    requirement_cells = _requirement_cells(notebook)
-    if len(requirement_cells) == 0:
+def get_requirements(cell):
+    if cell is None:
         raise InvalidRequirements("Couldn't find any requirements")
-    elif len(requirement_cells) > 1:
-        raise InvalidRequirements("Only one requirement cell is allowed, but found multiple")
 
-    cell = requirement_cells[0]
-    if _is_raw_requirement_cell(cell):
+    if is_raw_requirement_cell(cell):
         requirements = _extract_raw_requirement_cell(cell)
-    elif _is_comment_requirement_cell(cell):
-        requirements = _extract_comment_requirement_cell(cell)
     else:
-        raise AssertionError
+        requirements = _extract_comment_requirement_cell(cell)
 
     _sanity_check_requirements(requirements)
     return requirements
 
 
+def extract_requirements(notebook):
+    _, requirement_cell = split_notebook_cells(notebook)
+    return get_requirements(requirement_cell)
+
+
 def get_setup_file_content(requirements, name, description):
+    return _get_setup_file_content(tuple(requirements), name, description)
+
+
+@functools.lru_cache(maxsize=8)
+def _get_setup_file_content(requirements, name, description):
     requirements_str = "[" + ", ".join(['"{}"'.format(r) for r in requirements]) + "]"
     lines = []
 
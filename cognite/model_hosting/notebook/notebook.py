@@ -1,14 +1,33 @@
+import functools
+import hashlib
 import json
 import os
-import re
+import string
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
 from shutil import rmtree
-from time import sleep
+from time import monotonic, sleep
 from typing import Any, Callable, Dict, Optional
 from urllib.parse import urljoin
 
-from cognite.client.experimental import CogniteClient
-from cognite.model_hosting.notebook._model_file import AvailableOperations, extract_source_code, get_model_file_content
-from cognite.model_hosting.notebook._setup_file import extract_requirements, get_setup_file_content
+from cognite.model_hosting.notebook._cells import split_notebook_cells
+from cognite.model_hosting.notebook._model_file import AvailableOperations, get_model_file_content, get_source_code
+from cognite.model_hosting.notebook._setup_file import get_requirements, get_setup_file_content
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from typing import TYPE_CHECKING
+except ImportError:
+    # typing.TYPE_CHECKING was added in Python 3.5.2
+    TYPE_CHECKING = False
+
+if TYPE_CHECKING:
+    from cognite.client.experimental import CogniteClient
 
 
 def local_artifacts(model_version_name: str, root_dir: Optional[str] = None) -> Callable:
@@ -35,11 +54,16 @@ def local_artifacts(model_version_name: str, root_dir: Optional[str] = None) ->
                 f.write('A cool file\\n') # will be stored in artifacts/my-model/my_file.txt
     """
     root_dir = root_dir or os.getenv("MODEL_HOSTING_NOTEBOOK_ROOT") or os.getcwd()
+    artifacts_dir = os.path.join(root_dir, "artifacts", model_version_name)
 
     def open_artifact(path, *args, **kwargs):
-        path = os.path.join(root_dir, "artifacts", model_version_name, path)
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        return open(path, *args, **kwargs)
+        path = os.path.join(artifacts_dir, path)
+        try:
+            return open(path, *args, **kwargs)
+        except FileNotFoundError:
+            # Only create the directories when they are missing, instead of checking on every call
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            return open(path, *args, **kwargs)
 
     return open_artifact
 
@@ -50,70 +74,187 @@ class UnsupportedNotebookVersion(Exception):
     pass
 
 
-def _read_notebook(path):
-    with open(path, "r") as f:
-        notebook = json.load(f)
+def _parse_notebook(content):
+    if orjson is not None:
+        notebook = orjson.loads(content)
+    else:
+        notebook = json.loads(content.decode("utf-8"))
 
     if notebook["nbformat"] != 4:
         raise UnsupportedNotebookVersion("Only notebook format version 4 (nbformat==4) is supported")
 
+    # Outputs are never used when creating the package, and they often make up most of the notebook
+    for cell in notebook["cells"]:
+        cell.pop("outputs", None)
+        cell.pop("execution_count", None)
+
     return notebook
 
 
-def _create_package(notebook_path, available_operations, name, description, build_dir):
-    notebook = _read_notebook(notebook_path)
-    requirements = extract_requirements(notebook)
-    source_code = extract_source_code(notebook)
+def _extract_source_code_and_requirements(notebook):
+    model_cells, requirement_cell = split_notebook_cells(notebook)
+    return get_source_code(model_cells), get_requirements(requirement_cell)
+
+
+# Keyed on a digest of the notebook file content, so rebuilding an unchanged notebook skips parsing and extraction
+# without keeping the (often large) notebook content alive
+_source_code_and_requirements_cache = OrderedDict()
+_SOURCE_CODE_AND_REQUIREMENTS_CACHE_SIZE = 4
+
 
-    rmtree(build_dir, ignore_errors=True)
-    name_path_format = name.replace("-", "_")
-    package_dir = os.path.join(build_dir, name_path_format)
-    module_dir = os.path.join(package_dir, name_path_format)
+def _get_source_code_and_requirements(notebook_content):
+    key = hashlib.sha256(notebook_content).digest()
+    if key in _source_code_and_requirements_cache:
+        _source_code_and_requirements_cache.move_to_end(key)
+        return _source_code_and_requirements_cache[key]
+
+    result = _extract_source_code_and_requirements(_parse_notebook(notebook_content))
+    _source_code_and_requirements_cache[key] = result
+    if len(_source_code_and_requirements_cache) > _SOURCE_CODE_AND_REQUIREMENTS_CACHE_SIZE:
+        _source_code_and_requirements_cache.popitem(last=False)
+    return result
+
+
+def _write_file(path, content):
+    path = Path(path)
+    if path.is_file():
+        if path.read_text() == content:
+            return
+    elif not content:
+        path.touch()
+        return
+
+    path.write_text(content)
+
+
+def _remove_stale_files(directory, paths):
+    # Walking bottom-up, so directories emptied by removing their stale files (like dist/ or *.egg-info/ left by
+    # setup.py) are removed after their contents
+    directories = {os.path.dirname(path) for path in paths}
+    for dirpath, _, filenames in os.walk(directory, topdown=False):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if path not in paths:
+                os.remove(path)
+        if dirpath not in directories and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+
+
+def _create_package(notebook_path, available_operations, name, module_name, description, build_dir, force=False):
+    with open(notebook_path, "rb") as f:
+        source_code, requirements = _get_source_code_and_requirements(f.read())
+
+    if force:
+        rmtree(build_dir, ignore_errors=True)
+    package_dir = os.path.join(build_dir, module_name)
+    module_dir = os.path.join(package_dir, module_name)
     os.makedirs(module_dir, exist_ok=True)
 
-    with open(os.path.join(package_dir, "__init__.py"), "w") as f:
-        pass
+    files = [
+        (os.path.join(package_dir, "__init__.py"), ""),
+        (os.path.join(module_dir, "__init__.py"), ""),
+        (os.path.join(package_dir, "setup.py"), get_setup_file_content(requirements, name, description)),
+        (os.path.join(module_dir, "model.py"), get_model_file_content(source_code, available_operations)),
+    ]
+    _remove_stale_files(package_dir, {path for path, _ in files})
+    # Files with unchanged content are left untouched, so repeated builds of the same notebook don't rewrite them
+    with ThreadPoolExecutor(max_workers=len(files)) as executor:
+        list(executor.map(_write_file, *zip(*files)))
+
+
+# Maps kernel ids to the notebook server running them. The notebook path itself is not cached, since it changes when
+# the notebook is renamed or saved under a new name
+_notebook_servers = {}
+
 
-    with open(os.path.join(module_dir, "__init__.py"), "w") as f:
-        pass
+def _list_server_sessions(server):
+    import requests
+
+    # A server that is unreachable or doesn't answer with a session list can't be running our kernel, so it is skipped
+    try:
+        response = requests.get(
+            urljoin(server["url"], "api/sessions"), params={"token": server.get("token", "")}, timeout=1.0
+        )
+        response.raise_for_status()
+        return server, json.loads(response.text)
+    except (requests.RequestException, ValueError):
+        return server, []
 
-    with open(os.path.join(package_dir, "setup.py"), "w") as f:
-        f.write(get_setup_file_content(requirements, name, description))
 
-    with open(os.path.join(module_dir, "model.py"), "w") as f:
-        f.write(get_model_file_content(source_code, available_operations))
+def _get_kernel_notebook_path(kernel_id, server, sessions):
+    for nn in sessions:
+        if nn["kernel"]["id"] == kernel_id:
+            return os.path.join(server["notebook_dir"], nn["notebook"]["path"])
+    return None
 
 
 def _find_notebook_path():
     import ipykernel
-    import requests
     from notebook.notebookapp import list_running_servers
 
-    kernel_id = re.search("kernel-(.*).json", ipykernel.connect.get_connection_file()).group(1)
-    servers = list_running_servers()
-    for ss in servers:
-        response = requests.get(urljoin(ss["url"], "api/sessions"), params={"token": ss.get("token", "")})
-        for nn in json.loads(response.text):
-            if nn["kernel"]["id"] == kernel_id:
-                relative_path = nn["notebook"]["path"]
-                return os.path.join(ss["notebook_dir"], relative_path)
+    # The connection file is named kernel-<kernel id>.json
+    connection_file = os.path.basename(ipykernel.connect.get_connection_file())
+    kernel_id = connection_file[len("kernel-") : -len(".json")]
+
+    server = _notebook_servers.get(kernel_id)
+    if server is not None:
+        notebook_path = _get_kernel_notebook_path(kernel_id, *_list_server_sessions(server))
+        if notebook_path is not None:
+            return notebook_path
+
+    servers = list(list_running_servers())
+    if not servers:
+        return None
+
+    # Not using the executor as a context manager, since that would wait for the slower servers after a match
+    executor = ThreadPoolExecutor(max_workers=len(servers))
+    try:
+        futures = [executor.submit(_list_server_sessions, ss) for ss in servers]
+        for future in as_completed(futures):
+            ss, sessions = future.result()
+            notebook_path = _get_kernel_notebook_path(kernel_id, ss, sessions)
+            if notebook_path is not None:
+                _notebook_servers[kernel_id] = ss
+                return notebook_path
+    finally:
+        executor.shutdown(wait=False)
+
+
+class _PackageNameTranslation(dict):
+    """Translation table for str.translate() which deletes every character it doesn't explicitly map."""
+
+    def __missing__(self, key):
+        return None
+
+
+_PACKAGE_NAME_TRANSLATION = _PackageNameTranslation({ord(c): c for c in string.ascii_lowercase + string.digits + "-"})
+_PACKAGE_NAME_TRANSLATION[ord("_")] = "-"
 
 
 def _sanitize_package_name(name):
-    name = name.lower()
-    name = name.replace("_", "-")
-    name = re.sub(r"^[^a-z]+", "", name)
-    name = re.sub(r"[^0-9a-z-]", "", name)
-    return name
+    name = name.lower().translate(_PACKAGE_NAME_TRANSLATION)
+    return name.lstrip(string.digits + "-")
 
 
-def _wait_on_uploaded_source_package(source_package_id, model_hosting_client):
-    for i in range(10):
-        sleep(0.5)
+def _wait_on_uploaded_source_package(source_package_id, model_hosting_client, timeout=10):
+    deadline = monotonic() + timeout
+    delay = 0.05
+    while True:
         source_package = model_hosting_client.source_packages.get_source_package(source_package_id)
         if source_package.is_uploaded:
             return
-    raise TimeoutError("Uploading of source package timed out")
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            raise TimeoutError("Uploading of source package timed out")
+        sleep(min(delay, remaining))
+        delay = min(delay * 2, 2)
+
+
+@functools.lru_cache(maxsize=1)
+def _default_client():
+    from cognite.client.experimental import CogniteClient
+
+    return CogniteClient()
 
 
 def deploy_model_version(
@@ -124,7 +265,7 @@ def deploy_model_version(
     description: Optional[str] = None,
     metadata: Optional[Dict[str, str]] = None,
     notebook_path: Optional[str] = None,
-    cognite_client: Optional[CogniteClient] = None,
+    cognite_client: Optional["CogniteClient"] = None,
 ) -> int:
     """Deploy the model version in the current notebook to the model hosting environment.
 
@@ -138,18 +279,21 @@ def deploy_model_version(
         metadata (Dict[str,str], optional): Any metadata to include about this model verison.
         notebook_path (str, optional): The path to the notebook. If omitted, the notebook you're in will be used.
         cognite_client (CogniteClient, optional): The CogniteClient instance to use for uploading the model.
-            If omitted, a new instance will be created using the API key in the COGNITE_API_KEY environment variable.
+            If omitted, an instance using the API key in the COGNITE_API_KEY environment variable is created on the
+            first call and reused for the rest of the process, so later changes to COGNITE_API_KEY are ignored.
     Returns:
         int: The model version id
     """
     notebook_path = notebook_path or _find_notebook_path()
-    cognite_client = cognite_client or CogniteClient()
+    cognite_client = cognite_client or _default_client()
 
     package_name = _sanitize_package_name(version_name)
+    module_name = package_name.replace("-", "_")
     _create_package(
         notebook_path=notebook_path,
         available_operations=AvailableOperations.PREDICT,
         name=package_name,
+        module_name=module_name,
         description=description,
         build_dir="build",
     )
@@ -157,7 +301,7 @@ def deploy_model_version(
     source_package = model_hosting.source_packages.build_and_upload_source_package(
         name=version_name,
         runtime_version=runtime_version,
-        package_directory=os.path.join("build", package_name.replace("-", "_")),
+        package_directory=os.path.join("build", module_name),
         description=description,
         metadata=metadata,
     )
@@ -1,8 +1,6 @@
 import re
 
-from setuptools import find_packages, setup
-
-packages = find_packages(exclude=["tests*"])
+from setuptools import setup
 
 version = re.search('^__version__\s*=\s*"(.*)"', open("cognite/model_hosting/notebook/__init__.py").read(), re.M).group(
     1
@@ -17,5 +15,6 @@ setup(
     author_email="nils.barlaug@cognite.com",
     packages=["cognite.model_hosting.notebook"],
     install_requires=["cognite-sdk>=1.4.0,<2.0.0", "requests"],
+    extras_require={"orjson": ["orjson"]},
     python_requires=">=3.5",
 )
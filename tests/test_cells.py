@@ -0,0 +1,48 @@
+import pytest
+
+from cognite.model_hosting.notebook._cells import (
+    MODEL_MARKER,
+    REQUIREMENTS_MARKER,
+    InvalidRequirements,
+    get_cell_marker,
+    split_notebook_cells,
+)
+
+
+@pytest.mark.parametrize(
+    "cell, expected_marker",
+    [
+        ({"cell_type": "code", "source": ["# !model\n", "abc"]}, MODEL_MARKER),
+        ({"cell_type": "code", "source": ["#  !model  "]}, MODEL_MARKER),
+        ({"cell_type": "code", "source": ["# !requirements\n", "# numpy"]}, REQUIREMENTS_MARKER),
+        ({"cell_type": "code", "source": ["# !models\n"]}, None),
+        ({"cell_type": "code", "source": ["abc # !model\n"]}, None),
+        ({"cell_type": "code", "source": []}, None),
+        ({"cell_type": "raw", "source": ["# !requirements\n"]}, None),
+    ],
+)
+def test_get_cell_marker(cell, expected_marker):
+    assert expected_marker == get_cell_marker(cell)
+
+
+def test_split_notebook_cells():
+    model_cell = {"cell_type": "code", "source": ["# !model\n", "abc"]}
+    tagged_model_cell = {"cell_type": "code", "source": ["abc"], "metadata": {"tags": ["model"]}}
+    requirement_cell = {"cell_type": "code", "source": ["# !requirements\n", "# numpy"]}
+    other_cell = {"cell_type": "code", "source": ["abc"]}
+    notebook = {"cells": [model_cell, requirement_cell, other_cell, tagged_model_cell]}
+
+    model_cells, found_requirement_cell = split_notebook_cells(notebook)
+    assert [model_cell, tagged_model_cell] == model_cells
+    assert requirement_cell is found_requirement_cell
+
+
+def test_split_notebook_cells_stops_at_second_requirement_cell():
+    requirement_cell = {"cell_type": "code", "source": ["# !requirements\n", "# numpy"]}
+    raw_requirement_cell = {"cell_type": "raw", "source": ["numpy"], "metadata": {"tags": ["requirements"]}}
+    # Would raise a KeyError if the cells after the second requirement cell were inspected
+    malformed_cell = {}
+    notebook = {"cells": [requirement_cell, raw_requirement_cell, malformed_cell]}
+
+    with pytest.raises(InvalidRequirements, match="one requirement cell"):
+        split_notebook_cells(notebook)
@@ -1,10 +1,14 @@
+from unittest.mock import patch
+
 import pytest
 
 from cognite.model_hosting.notebook._model_file import (
+    AvailableOperations,
     InvalidCodeFormat,
     _source_code_has_load_and_predict,
     _source_code_has_train,
     extract_source_code,
+    get_model_file_content,
 )
 
 
@@ -41,6 +45,21 @@ def train_model(open_artifact, data_spec):
         """
 def train_model(open_artifact):
     pass
+""",
+        """
+def train_model(open_artifact, *args, data_spec, **kwargs):
+    pass
+""",
+        """
+def train_model(
+    open_artifact,
+    data_spec=(1, 2),
+):
+    pass
+""",
+        """
+def train_model(open_artifact, *, data_spec=None):
+    pass
 """,
     ]
     FALSE_CASES = [
@@ -73,6 +92,10 @@ def train_model(open_artifact):
     pass
 def train_model(open_artifact):
     pass
+""",
+        """
+def train_model(open_artifact, data_spec, data_spec):
+    pass
 """,
     ]
 
@@ -122,6 +145,14 @@ def predict(instance):
         ),
         (
             """
+def predict(instance, threshold=0.5):
+    pass
+""",
+            False,
+            True,
+        ),
+        (
+            """
 def something():
     pass
 """,
@@ -177,6 +208,12 @@ def load_model(open_artifact):
     pass
 def predict(model, instance):
     pass
+""",
+        """
+def load_model(open_artifact, **kwargs):
+    pass
+def predict(model, instance):
+    pass
 """,
     ]
 
@@ -190,3 +227,108 @@ def predict(model, instance):
     def test_invalid(self, source_code):
         with pytest.raises(InvalidCodeFormat, match="(load_model|predict)"):
             _source_code_has_load_and_predict(source_code)
+
+
+def test_invalid_syntax():
+    with pytest.raises(InvalidCodeFormat, match="not valid Python"):
+        _source_code_has_train("def train_model(open_artifact:\n    pass\n")
+
+
+class TestGetModelFileContent:
+    @pytest.mark.parametrize(
+        "source_code, expected_glue_code",
+        [
+            (
+                "def train_model(open_artifact, data_spec):\n    pass",
+                "    def train(open_artifact, data_spec):\n        train_model(open_artifact, data_spec)\n",
+            ),
+            (
+                "def train_model(open_artifact, *args, **kwargs):\n    pass",
+                "    def train(open_artifact, *args, **kwargs):\n        train_model(open_artifact, *args, **kwargs)\n",
+            ),
+            (
+                "def train_model(open_artifact, data_spec, *, epochs):\n    pass",
+                "    def train(open_artifact, data_spec, *, epochs):\n"
+                "        train_model(open_artifact, data_spec, epochs=epochs)\n",
+            ),
+            (
+                "def train_model(\n    open_artifact,\n    data_spec=(1, 2),\n):\n    pass",
+                "    def train(open_artifact, data_spec=(1, 2)):\n        train_model(open_artifact, data_spec=data_spec)\n",
+            ),
+            (
+                'def train_model(open_artifact, sep=")", *, epochs=[1,\n 2]):\n    pass',
+                '    def train(open_artifact, sep=")", *, epochs=[1,\n 2]):\n'
+                "        train_model(open_artifact, sep=sep, epochs=epochs)\n",
+            ),
+            (
+                "def train_model(open_artifact, data_spec=None, *args, epochs: int = 1):\n    pass",
+                "    def train(open_artifact, data_spec=None, *args, epochs=1):\n"
+                "        train_model(open_artifact, data_spec, *args, epochs=epochs)\n",
+            ),
+            (
+                "def train_model(open_artifact, *args, epochs, **kwargs):\n    pass",
+                "    def train(open_artifact, *args, epochs, **kwargs):\n"
+                "        train_model(open_artifact, *args, epochs=epochs, **kwargs)\n",
+            ),
+        ],
+    )
+    def test_train_glue_code(self, source_code, expected_glue_code):
+        content = get_model_file_content(source_code, AvailableOperations.TRAIN)
+        assert expected_glue_code in content
+
+    @pytest.mark.parametrize(
+        "source_code, expected_glue_code",
+        [
+            (
+                "def predict(instance, *args, scale, **kwargs):\n    pass",
+                "    def predict(self, instance, *args, scale, **kwargs):\n"
+                "        return predict(instance, *args, scale=scale, **kwargs)\n",
+            ),
+            (
+                "def load_model(open_artifact):\n    pass\ndef predict(model, instance, threshold=0.5):\n    pass",
+                "    def predict(self, instance, threshold=0.5):\n"
+                "        return predict(self._model, instance, threshold=threshold)\n",
+            ),
+            (
+                "@decorate\ndef predict(instance, threshold=lambda x=1: x):\n    pass",
+                "    def predict(self, instance, threshold=lambda x=1: x):\n"
+                "        return predict(instance, threshold=threshold)\n",
+            ),
+            (
+                "def load_model(open_artifact):\n    pass\ndef predict(model, instance, *, scale):\n    pass",
+                "    def predict(self, instance, *, scale):\n"
+                "        return predict(self._model, instance, scale=scale)\n",
+            ),
+        ],
+    )
+    def test_predict_glue_code(self, source_code, expected_glue_code):
+        content = get_model_file_content(source_code, AvailableOperations.PREDICT)
+        assert expected_glue_code in content
+
+    def test_generated_code_is_callable(self):
+        source_code = "def predict(instance, *args, scale, **kwargs):\n    return instance, args, scale, kwargs"
+        namespace = {}
+        exec(get_model_file_content(source_code, AvailableOperations.PREDICT), namespace)
+        model = namespace["Model"].load(None)
+        assert (1, (2,), 3, {"x": 4}) == model.predict(1, 2, scale=3, x=4)
+
+    def test_generated_code_keeps_defaults(self):
+        source_code = (
+            "DEFAULT_THRESHOLD = 0.5\n"
+            "def load_model(open_artifact):\n    return 2\n"
+            "def predict(model, instance, threshold=DEFAULT_THRESHOLD, *, scale=1):\n"
+            "    return model * instance * scale > threshold"
+        )
+        namespace = {}
+        exec(get_model_file_content(source_code, AvailableOperations.PREDICT), namespace)
+        model = namespace["Model"].load(None)
+        assert model.predict(1)
+        assert not model.predict(1, threshold=3)
+        assert not model.predict(1, 3)
+        assert model.predict(1, 3, scale=2)
+
+    def test_source_code_without_functions_is_not_parsed(self):
+        with patch("cognite.model_hosting.notebook._model_file._get_function_definitions") as get_function_definitions:
+            with pytest.raises(InvalidCodeFormat, match="Missing required predict"):
+                get_model_file_content("a = 5", AvailableOperations.PREDICT)
+        get_function_definitions.assert_not_called()
@@ -1,23 +1,34 @@
+import filecmp
 import json
 import os
 import tempfile
 from collections import namedtuple
-from glob import glob
 from shutil import rmtree
 from unittest.mock import MagicMock, patch
 
 import pytest
+import requests
 
 from cognite.model_hosting.notebook.notebook import (
     AvailableOperations,
     UnsupportedNotebookVersion,
     _create_package,
-    _read_notebook,
+    _default_client,
+    _extract_source_code_and_requirements,
+    _find_notebook_path,
+    _get_source_code_and_requirements,
+    _parse_notebook,
     _sanitize_package_name,
+    _wait_on_uploaded_source_package,
     deploy_model_version,
     local_artifacts,
 )
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 @pytest.fixture(scope="session", autouse=True)
 def working_dir():
@@ -49,6 +60,13 @@ class TestLocalArtifacts:
             self.run_test(lambda name: local_artifacts(name), dir)
             del os.environ["MODEL_HOSTING_NOTEBOOK_ROOT"]
 
+    def test_nested_path(self):
+        with tempfile.TemporaryDirectory() as dir:
+            open_artifact = local_artifacts("some_model", root_dir=dir)
+            with open_artifact(os.path.join("sub", "model.txt"), "w") as f:
+                f.write("123")
+            assert os.path.isfile(os.path.join(dir, "artifacts", "some_model", "sub", "model.txt"))
+
     def run_test(self, _local_artifacts, root_dir):
         expected_path = os.path.join(root_dir, "artifacts", "some_model", "model.txt")
         assert not os.path.exists(expected_path)  # Make sure it doesn't already exist from last run
@@ -66,55 +84,254 @@ class TestLocalArtifacts:
             assert "123" == f.read()
 
 
-class TestReadNotebook:
+class TestParseNotebook:
     VALID_VERSION = {"cells": [], "nbformat": 4}
     INVALID_VERSION = {"cells": [], "nbformat": 5}
 
+    @staticmethod
+    def dumps(notebook):
+        if orjson is not None:
+            return orjson.dumps(notebook)
+        return json.dumps(notebook).encode("utf-8")
+
     def test_valid_version(self):
-        with tempfile.TemporaryDirectory() as dir:
-            path = os.path.join(dir, "notebook.ipynb")
-            with open(path, "w") as f:
-                json.dump(self.VALID_VERSION, f)
-            assert {"cells": [], "nbformat": 4} == _read_notebook(path)
+        assert {"cells": [], "nbformat": 4} == _parse_notebook(self.dumps(self.VALID_VERSION))
+
+    @patch("cognite.model_hosting.notebook.notebook.orjson", None)
+    def test_valid_version_without_orjson(self):
+        assert {"cells": [], "nbformat": 4} == _parse_notebook(self.dumps(self.VALID_VERSION))
+
+    def test_outputs_are_dropped(self):
+        notebook = {
+            "cells": [
+                {"cell_type": "code", "execution_count": 1, "metadata": {}, "outputs": [{}], "source": ["a = 5"]}
+            ],
+            "nbformat": 4,
+        }
+        expected_cells = [{"cell_type": "code", "metadata": {}, "source": ["a = 5"]}]
+        assert expected_cells == _parse_notebook(self.dumps(notebook))["cells"]
 
     def test_invalid_version(self):
-        with tempfile.TemporaryDirectory() as dir:
-            path = os.path.join(dir, "notebook.ipynb")
-            with open(path, "w") as f:
-                json.dump(self.INVALID_VERSION, f)
-            with pytest.raises(UnsupportedNotebookVersion):
-                _read_notebook(path)
+        with pytest.raises(UnsupportedNotebookVersion):
+            _parse_notebook(self.dumps(self.INVALID_VERSION))
 
 
-@pytest.mark.parametrize(
-    "example, available_operations",
-    [
+@patch.dict("cognite.model_hosting.notebook.notebook._source_code_and_requirements_cache", clear=True)
+@patch("cognite.model_hosting.notebook.notebook._extract_source_code_and_requirements", return_value=("", []))
+def test_source_code_and_requirements_cache_is_bounded(extract_mock):
+    from cognite.model_hosting.notebook.notebook import _source_code_and_requirements_cache
+
+    contents = [TestParseNotebook.dumps({"cells": [], "nbformat": 4, "metadata": {"i": i}}) for i in range(5)]
+    for content in contents:
+        _get_source_code_and_requirements(content)
+    assert 4 == len(_source_code_and_requirements_cache)
+
+    _get_source_code_and_requirements(contents[-1])
+    assert 5 == extract_mock.call_count
+    _get_source_code_and_requirements(contents[0])
+    assert 6 == extract_mock.call_count
+
+
+def test_extract_source_code_and_requirements():
+    notebook = {
+        "cells": [
+            {"cell_type": "raw", "metadata": {"tags": ["requirements"]}, "source": ["numpy==1.2.3\n", "pandas"]},
+            {"cell_type": "code", "metadata": {}, "source": ["# !model\n", "abc"]},
+            {"cell_type": "code", "metadata": {}, "source": ["this should be ignored"]},
+        ]
+    }
+    source_code, requirements = _extract_source_code_and_requirements(notebook)
+    assert "# !notebook-cell\n# !model\nabc\n" == source_code
+    assert ["numpy==1.2.3", "pandas"] == requirements
+
+
+def _walk_files(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d != "__pycache__"]
+        for filename in filenames:
+            yield os.path.relpath(os.path.join(dirpath, filename), root)
+
+
+@pytest.fixture(
+    scope="session",
+    params=[
         ("train_predict_example", AvailableOperations.PREDICT_TRAIN),
         ("train_example", AvailableOperations.TRAIN),
         ("predict_example", AvailableOperations.PREDICT),
         ("predict_without_load_example", AvailableOperations.PREDICT),
     ],
+    ids=lambda param: param[0],
 )
-def test_create_package(example, available_operations):
+def built_package(request, working_dir, tmp_path_factory):
+    example, available_operations = request.param
+    build_dir = str(tmp_path_factory.mktemp("build"))
     _create_package(
-        os.path.join(example, "notebook.ipynb"), available_operations, "some_name", "some description", "build"
+        os.path.join(example, "notebook.ipynb"),
+        available_operations,
+        "some_name",
+        "some_name",
+        "some description",
+        build_dir,
     )
+    return os.path.join(example, "expected_build"), build_dir
+
+
+class TestCreatePackage:
+    def test_files(self, built_package):
+        expected_root, build_dir = built_package
+        assert sorted(_walk_files(expected_root)) == sorted(_walk_files(build_dir))
+
+    def test_file_contents(self, built_package):
+        expected_root, build_dir = built_package
+        _, mismatch, errors = filecmp.cmpfiles(expected_root, build_dir, _walk_files(expected_root), shallow=False)
+        assert [] == mismatch
+        assert [] == errors
+
+
+class TestCreatePackageRebuild:
+    def create_package(self, build_dir, force=False):
+        _create_package(
+            os.path.join("train_predict_example", "notebook.ipynb"),
+            AvailableOperations.PREDICT_TRAIN,
+            "some_name",
+            "some_name",
+            "some description",
+            build_dir,
+            force=force,
+        )
 
-    expected_files = sorted(
-        [
-            f
-            for f in glob(os.path.join(example, "expected_build/**"), recursive=True)
-            if os.path.isfile(f) and not "__pycache__" in f
+    def test_unchanged_files_are_not_rewritten(self, tmpdir):
+        model_path = os.path.join(str(tmpdir), "some_name", "some_name", "model.py")
+        self.create_package(str(tmpdir))
+        os.utime(model_path, (0, 0))
+
+        self.create_package(str(tmpdir))
+        assert 0 == os.stat(model_path).st_mtime
+
+    def test_changed_and_stale_files(self, tmpdir):
+        package_dir = os.path.join(str(tmpdir), "some_name")
+        self.create_package(str(tmpdir))
+        with open(os.path.join(package_dir, "setup.py"), "w") as f:
+            f.write("changed")
+        with open(os.path.join(package_dir, "__init__.py"), "w") as f:
+            f.write("changed")
+        with open(os.path.join(package_dir, "some_name", "stale.py"), "w") as f:
+            f.write("stale")
+
+        self.create_package(str(tmpdir))
+        with open(os.path.join(package_dir, "setup.py")) as f:
+            assert "changed" != f.read()
+        with open(os.path.join(package_dir, "__init__.py")) as f:
+            assert "" == f.read()
+        assert not os.path.exists(os.path.join(package_dir, "some_name", "stale.py"))
+
+    def test_stale_directories(self, tmpdir):
+        package_dir = os.path.join(str(tmpdir), "some_name")
+        self.create_package(str(tmpdir))
+        os.makedirs(os.path.join(package_dir, "dist"))
+        with open(os.path.join(package_dir, "dist", "some_name-1.0.tar.gz"), "w") as f:
+            f.write("stale")
+        os.makedirs(os.path.join(package_dir, "some_name.egg-info", "empty"))
+
+        self.create_package(str(tmpdir))
+        assert ["__init__.py", "setup.py", "some_name"] == sorted(os.listdir(package_dir))
+        assert ["__init__.py", "model.py"] == sorted(os.listdir(os.path.join(package_dir, "some_name")))
+
+    def test_unchanged_notebook_is_not_parsed_again(self, tmpdir):
+        with patch.dict(
+            "cognite.model_hosting.notebook.notebook._source_code_and_requirements_cache", clear=True
+        ), patch(
+            "cognite.model_hosting.notebook.notebook._parse_notebook", wraps=_parse_notebook
+        ) as parse_notebook_mock:
+            self.create_package(str(tmpdir))
+            self.create_package(str(tmpdir))
+        assert 1 == parse_notebook_mock.call_count
+
+    def test_force(self, tmpdir):
+        other_file = os.path.join(str(tmpdir), "other.txt")
+        with open(other_file, "w") as f:
+            f.write("other")
+
+        self.create_package(str(tmpdir), force=True)
+        assert not os.path.exists(other_file)
+        assert os.path.isfile(os.path.join(str(tmpdir), "some_name", "some_name", "model.py"))
+
+
+class TestFindNotebookPath:
+    @pytest.fixture
+    def jupyter(self, tmpdir):
+        ipykernel = MagicMock()
+        ipykernel.connect.get_connection_file.return_value = "/run/jupyter/kernel-abc-123.json"
+        notebookapp = MagicMock()
+        notebookapp.list_running_servers.return_value = iter(
+            [
+                {"url": "http://localhost:8888/", "token": "secret", "notebook_dir": str(tmpdir)},
+                {"url": "http://localhost:8889/", "notebook_dir": "/other"},
+            ]
+        )
+        responses = {
+            "http://localhost:8888/api/sessions": [
+                {"kernel": {"id": "abc-123"}, "notebook": {"path": "notebook.ipynb"}}
+            ],
+            "http://localhost:8889/api/sessions": [{"kernel": {"id": "def-456"}, "notebook": {"path": "other.ipynb"}}],
+        }
+
+        def get(url, **kwargs):
+            if isinstance(responses[url], Exception):
+                raise responses[url]
+            if isinstance(responses[url], str):
+                return MagicMock(text=responses[url])
+            return MagicMock(text=json.dumps(responses[url]))
+
+        modules = {
+            "ipykernel": ipykernel,
+            "notebook": MagicMock(notebookapp=notebookapp),
+            "notebook.notebookapp": notebookapp,
+        }
+        with patch.dict("sys.modules", modules), patch("requests.get", side_effect=get) as get_mock, patch.dict(
+            "cognite.model_hosting.notebook.notebook._notebook_servers", clear=True
+        ):
+            yield get_mock, responses, str(tmpdir)
+
+    def test_find_notebook_path(self, jupyter):
+        get_mock, _, notebook_dir = jupyter
+        assert os.path.join(notebook_dir, "notebook.ipynb") == _find_notebook_path()
+        get_mock.assert_any_call("http://localhost:8888/api/sessions", params={"token": "secret"}, timeout=1.0)
+
+    def test_kernel_not_found(self, jupyter):
+        get_mock, responses, _ = jupyter
+        responses["http://localhost:8888/api/sessions"] = []
+        assert _find_notebook_path() is None
+        get_mock.assert_any_call("http://localhost:8888/api/sessions", params={"token": "secret"}, timeout=1.0)
+        get_mock.assert_any_call("http://localhost:8889/api/sessions", params={"token": ""}, timeout=1.0)
+
+    def test_unreachable_server_is_skipped(self, jupyter):
+        _, responses, notebook_dir = jupyter
+        responses["http://localhost:8889/api/sessions"] = requests.ConnectionError()
+        assert os.path.join(notebook_dir, "notebook.ipynb") == _find_notebook_path()
+
+    def test_server_with_invalid_response_is_skipped(self, jupyter):
+        _, responses, _ = jupyter
+        responses["http://localhost:8888/api/sessions"] = "<html>Not a session list</html>"
+        responses["http://localhost:8889/api/sessions"] = [
+            {"kernel": {"id": "abc-123"}, "notebook": {"path": "notebook.ipynb"}}
         ]
-    )
-    generated_files = sorted([f for f in glob("build/**", recursive=True) if os.path.isfile(f)])
-    assert len(expected_files) == len(generated_files)
+        assert os.path.join("/other", "notebook.ipynb") == _find_notebook_path()
+
+    def test_cached_notebook_server(self, jupyter):
+        get_mock, _, _ = jupyter
+        _find_notebook_path()
+        get_mock.reset_mock()
+        assert _find_notebook_path() is not None
+        get_mock.assert_called_once_with("http://localhost:8888/api/sessions", params={"token": "secret"}, timeout=1.0)
 
-    for file_path1, file_path2 in zip(expected_files, generated_files):
-        assert file_path1.endswith(file_path2)
-        with open(file_path1) as f1:
-            with open(file_path2) as f2:
-                assert f1.read() == f2.read()
+    def test_notebook_saved_as(self, jupyter):
+        get_mock, responses, notebook_dir = jupyter
+        _find_notebook_path()
+        get_mock.reset_mock()
+        responses["http://localhost:8888/api/sessions"][0]["notebook"]["path"] = "renamed.ipynb"
+        assert os.path.join(notebook_dir, "renamed.ipynb") == _find_notebook_path()
+        assert 1 == get_mock.call_count
 
 
 @pytest.mark.parametrize(
@@ -128,12 +345,45 @@ def test_create_package(example, available_operations):
         ("-something", "something"),
         ("some-thing", "some-thing"),
         ("#some^%$^thing", "something"),
+        ("1#2_some thing", "something"),
+        ("sóme_thing", "sme-thing"),
     ],
 )
 def test_sanitize_package_name(name, expected_output):
     assert expected_output == _sanitize_package_name(name)
 
 
+class TestWaitOnUploadedSourcePackage:
+    @staticmethod
+    def model_hosting_client(is_uploaded):
+        model_hosting = MagicMock()
+        model_hosting.source_packages.get_source_package.side_effect = [
+            namedtuple("SourcePackage", ["is_uploaded"])(u) for u in is_uploaded
+        ]
+        return model_hosting
+
+    @patch("cognite.model_hosting.notebook.notebook.sleep")
+    def test_uploaded(self, sleep_mock):
+        model_hosting = self.model_hosting_client([False, False, True])
+        _wait_on_uploaded_source_package(123, model_hosting)
+
+        model_hosting.source_packages.get_source_package.assert_called_with(123)
+        assert 3 == model_hosting.source_packages.get_source_package.call_count
+        assert [0.05, 0.1] == [c[0][0] for c in sleep_mock.call_args_list]
+
+    @patch("cognite.model_hosting.notebook.notebook.sleep")
+    def test_uploaded_immediately(self, sleep_mock):
+        _wait_on_uploaded_source_package(123, self.model_hosting_client([True]))
+        sleep_mock.assert_not_called()
+
+    @patch("cognite.model_hosting.notebook.notebook.monotonic", side_effect=[0, 1, 3])
+    @patch("cognite.model_hosting.notebook.notebook.sleep")
+    def test_timeout(self, sleep_mock, monotonic_mock):
+        with pytest.raises(TimeoutError):
+            _wait_on_uploaded_source_package(123, self.model_hosting_client([False, False]), timeout=2)
+        assert 1 == sleep_mock.call_count
+
+
 class TestDeployModelVersion:
     @patch("cognite.model_hosting.notebook.notebook._create_package")
     def test_check_all_calls(self, create_package):
@@ -160,6 +410,7 @@ class TestDeployModelVersion:
             notebook_path="path/notebook.ipynb",
             available_operations=AvailableOperations.PREDICT,
             name="some-name",
+            module_name="some_name",
             description="some description",
             build_dir="build",
         )
@@ -189,14 +440,22 @@ class TestDeployModelVersion:
 
         assert "path/notebook.py" == create_package.call_args[1]["notebook_path"]
 
-    @patch("cognite.model_hosting.notebook.notebook.CogniteClient")
+    @pytest.fixture
+    def clear_default_client(self):
+        _default_client.cache_clear()
+        yield
+        _default_client.cache_clear()
+
+    @pytest.mark.usefixtures("clear_default_client")
+    @patch("cognite.client.experimental.CogniteClient")
     @patch("cognite.model_hosting.notebook.notebook._create_package")
     def test_default_client(self, create_package, CogniteClient_mock):
-        deploy_model_version(
-            model_name="my_model",
-            version_name="123some_name",
-            runtime_version="0.1",
-            notebook_path="path/notebook.ipynb",
-        )
+        for _ in range(2):
+            deploy_model_version(
+                model_name="my_model",
+                version_name="123some_name",
+                runtime_version="0.1",
+                notebook_path="path/notebook.ipynb",
+            )
 
         CogniteClient_mock.assert_called_once_with()